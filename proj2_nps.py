@@ -3,18 +3,74 @@
 # Uniqname:
 #################################
 
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import atexit
+import functools
 import json
+import sqlite3
+import zlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import secrets  # file that contains your API key
 
-STATE_CACHE_FILENAME = "state_cache.json"
-PARK_CACHE_FILENAME = "park_cache.json"
-NEAR_CACHE_FILENAME = "near_cache.json"
-
-NEAR_CACHE_DICT = {}
-STATE_CACHE_DICT = {}
-PARK_CACHE_DICT = {}
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CACHE_FILENAME = "cache.db"
+# cached values at least this many bytes of JSON are stored compressed
+CACHE_COMPRESS_MIN_SIZE = 512
+CACHE_COMPRESS_LEVEL = 3
+
+# one shared session so repeated requests to the same host reuse
+# keep-alive connections instead of paying a new TCP+TLS handshake
+REQUEST_TIMEOUT = 10
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3)))
+SESSION.headers.update({"User-Agent": "SI507-proj2-nps/1.0"})
+
+# upper bound on concurrent site page fetches for one state
+SITE_WORKERS = 10
+
+# state url -> tuple of NationalSite objects built during this session
+PARK_OBJ_CACHE = {}
+
+# site key -> parsed MapQuest response looked up during this session
+NEAR_PLACES_CACHE = {}
+
+# how many listed sites get their nearby places fetched ahead of time,
+# and how many threads fetch them; kept small to stay under MapQuest's
+# rate limits
+NEAR_PREFETCH_COUNT = 5
+# site keys whose prefetch has not been stored yet
+NEAR_PREFETCH = set()
+# (site key, NationalSite) pairs waiting for a prefetch thread
+NEAR_PREFETCH_REQUESTS = queue.Queue()
+# (site key, raw MapQuest response or None on failure) from prefetch threads
+NEAR_PREFETCH_RESULTS = queue.Queue()
+NEAR_PREFETCH_THREADS = []
+
+BASE_URL = "https://www.nps.gov"
+INDEX_URL = BASE_URL + "/index.htm"
+MAPQUEST_URL = "https://www.mapquestapi.com/search/v2/radius"
+
+# CSS selectors used to scrape nps.gov pages
+STATE_LINK_SELECTOR = "ul.dropdown-menu.SearchBar-keywordSearch"
+STATE_SITE_SELECTOR = "li.clearfix"
+SITE_LINK_SELECTOR = "h3 a"
+SITE_NAME_SELECTOR = "a.Hero-title"
+SITE_CATEGORY_SELECTOR = "span.Hero-designation"
+SITE_ITEMPROP_SELECTOR = "span[itemprop]"
+# itemprop values read from a national site page
+SITE_ITEMPROPS = frozenset(
+    ("addressLocality", "addressRegion", "postalCode", "telephone"))
 
 
 class NationalSite:
@@ -37,19 +93,50 @@ class NationalSite:
 
     phone: string
         the phone of a national site (e.g. '(616) 319-7906', '307-344-7381')
+
+    Instances are treated as immutable after construction: info() is
+    built once in __init__ and instances are shared between callers, so
+    do not reassign these attributes.
     '''
 
+    FIELDS = ("category", "name", "address", "zipcode", "phone")
+    __slots__ = FIELDS + ("_info",)
+
     def __init__(self, category, name, address, zipcode, phone):
         self.category = category
         self.name = name
         self.address = address
         self.zipcode = zipcode
         self.phone = phone
+        self._info = "{} ({}): {} {}".format(
+            name, category, address, zipcode)
 
     def info(self):
-        information = "{} ({}): {} {}".format(
-            self.name, self.category, self.address, self.zipcode)
-        return information
+        return self._info
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+def get_page_tree(url):
+    ''' Fetches a page and parses it into a selectolax tree
+
+    The body is read as raw bytes straight off the socket and handed to
+    the parser, which decodes it in C, so requests never builds a str
+    copy of the page.
+
+    Parameters
+    ----------
+    url: string
+        The URL of the page
+
+    Returns
+    -------
+    LexborHTMLParser
+        the parsed page
+    '''
+    with SESSION.get(url, timeout=REQUEST_TIMEOUT, stream=True) as response:
+        return LexborHTMLParser(response.raw.read(decode_content=True))
 
 
 def build_state_url_dict():
@@ -65,28 +152,22 @@ def build_state_url_dict():
         key is a state name and value is the url
         e.g. {'michigan':'https://www.nps.gov/state/mi/index.htm', ...}
     '''
-    global STATE_CACHE_DICT
-    if not STATE_CACHE_DICT:
-        print("Fetching States!")
-        state_name_dict = {}
-        url = "https://www.nps.gov/index.htm"
-        response = requests.get(url)
-        soup = BeautifulSoup(response.text, "html.parser")
-        mydivs = soup.find_all(
-            "ul", class_="dropdown-menu SearchBar-keywordSearch")[0].find_all('a')
-
-        for i in range(len(mydivs)):
-            state_name_dict[mydivs[i].getText(
-            ).lower()] = "https://www.nps.gov" + mydivs[i]['href']
-
-        STATE_CACHE_DICT = state_name_dict
-        save_cache(STATE_CACHE_DICT, STATE_CACHE_FILENAME)
-        return STATE_CACHE_DICT
-    else:
+    state_name_dict = dict(CACHE.items("state_urls"))
+    if state_name_dict:
         print("Using cache!")
-        return STATE_CACHE_DICT
+        return state_name_dict
+    else:
+        print("Fetching States!")
+        tree = get_page_tree(INDEX_URL)
+        state_name_dict = {
+            link.text().lower(): BASE_URL + link.attributes['href']
+            for link in tree.css_first(STATE_LINK_SELECTOR).css("a")}
 
+        CACHE.put_many("state_urls", state_name_dict.items())
+        return state_name_dict
 
+
+@functools.lru_cache(maxsize=1024)
 def get_site_instance(site_url):
     '''Make an instances from a national site URL.
 
@@ -98,22 +179,22 @@ def get_site_instance(site_url):
     Returns
     -------
     instance
-        a national site instance
+        a national site instance, shared by every call with the same URL
     '''
-    response = requests.get(site_url)
-    soup = BeautifulSoup(response.text, "html.parser")
-    name = soup.find('a', class_="Hero-title").getText()
-    category = soup.find('span', class_="Hero-designation").getText()
-    address = soup.find('span', itemprop="addressLocality").getText()
-    state = soup.find('span', itemprop="addressRegion").getText()
-    zipcode = soup.find('span', itemprop="postalCode").getText()
-    telephone = soup.find('span', itemprop="telephone").getText()
-    state_address = address + ", " + state
+    tree = get_page_tree(site_url)
+    fields = {}
+    for node in tree.css(SITE_ITEMPROP_SELECTOR):
+        prop = node.attributes.get("itemprop")
+        if prop in SITE_ITEMPROPS and prop not in fields:
+            fields[prop] = node.text()
+    state_address = fields["addressLocality"] + ", " + fields["addressRegion"]
 
     ins = NationalSite(
-        category=category, name=name, address=state_address,
-        zipcode=zipcode.strip(),
-        phone=telephone[1:])
+        category=tree.css_first(SITE_CATEGORY_SELECTOR).text(),
+        name=tree.css_first(SITE_NAME_SELECTOR).text(),
+        address=state_address,
+        zipcode=fields["postalCode"].strip(),
+        phone=fields["telephone"][1:])
     return ins
 
 
@@ -156,23 +237,26 @@ def get_sites_for_state(state_url):
         a list of national site instances
     '''
 
-    if state_url in PARK_CACHE_DICT.keys():
+    if state_url in PARK_OBJ_CACHE:
+        print("Using cache")
+        return list(PARK_OBJ_CACHE[state_url])
+    cached_sites = CACHE.get("parks", state_url)
+    if cached_sites is not None:
         print("Using cache")
-        national_site_ins = cache_to_obj(PARK_CACHE_DICT[state_url])
+        national_site_ins = cache_to_obj(cached_sites)
+        PARK_OBJ_CACHE[state_url] = tuple(national_site_ins)
         return national_site_ins
     else:
         print("Fetching Parks!")
-        response = requests.get(state_url)
-        soup = BeautifulSoup(response.text, "html.parser")
-        base_url = "https://www.nps.gov"
-        national_site_ls = []
-        national_site_ins = []
-        for tmp in soup.find_all("li", class_="clearfix")[0:-1]:
-            url = base_url + tmp.find("h3").find('a')['href']
-            national_site_ls.append(get_site_instance(url).__dict__)
-            national_site_ins.append(get_site_instance(url))
-        PARK_CACHE_DICT[state_url] = national_site_ls
-        save_cache(PARK_CACHE_DICT, PARK_CACHE_FILENAME)
+        tree = get_page_tree(state_url)
+        site_urls = [BASE_URL + tmp.css_first(SITE_LINK_SELECTOR).attributes['href']
+                     for tmp in tree.css(STATE_SITE_SELECTOR)[0:-1]]
+        with ThreadPoolExecutor(max_workers=SITE_WORKERS) as executor:
+            national_site_ins = list(
+                executor.map(get_site_instance, site_urls))
+        national_site_ls = [ins.to_dict() for ins in national_site_ins]
+        CACHE.put("parks", state_url, national_site_ls)
+        PARK_OBJ_CACHE[state_url] = tuple(national_site_ins)
         return national_site_ins
 
 
@@ -190,67 +274,410 @@ def get_nearby_places(site_object):
         a converted API return from MapQuest API
     '''
     near_key = site_object.info()
-    if near_key in NEAR_CACHE_DICT.keys():
+    store_prefetched_places(wait_for=near_key)
+    if near_key in NEAR_PLACES_CACHE:
+        print("Using cache")
+        return NEAR_PLACES_CACHE[near_key]
+    cached_places = CACHE.get("near", near_key)
+    if cached_places is not None:
         print("Using cache")
-        return NEAR_CACHE_DICT[near_key]
+        NEAR_PLACES_CACHE[near_key] = cached_places
+        return cached_places
     else:
         print("Fetching near places")
-        url = "https://www.mapquestapi.com/search/v2/radius?origin ={}\
-        &radius={}&maxMatches={}&ambiguities={}\
-        &outFormat={}&key={}".format(site_object.address, 10, 10, "ignore", "json", secrets.API_KEY)
-        places = requests.get(url).json()
-        NEAR_CACHE_DICT[near_key] = places
-        save_cache(NEAR_CACHE_DICT, NEAR_CACHE_FILENAME)
-        return NEAR_CACHE_DICT[near_key]
+        content = fetch_nearby_places(site_object)
+        places = json_loads(content)
+        CACHE.put_raw("near", near_key, content)
+        NEAR_PLACES_CACHE[near_key] = places
+        return places
 
 
-def open_cache(cache_filename):
-    ''' Opens the cache file if it exists and loads the JSON into
-    the CACHE_DICT dictionary.
-    if the cache file doesn't exist, creates a new cache dictionary
+def fetch_nearby_places(site_object):
+    '''Request nearby places from the MapQuest API, bypassing the cache.
 
     Parameters
     ----------
-    None
+    site_object: object
+        an instance of a national site
 
     Returns
     -------
-    The opened cache: dict
+    bytes
+        the raw JSON body returned by MapQuest API
     '''
-    try:
-        cache_file = open(cache_filename, 'r')
-        cache_contents = cache_file.read()
-        cache_dict = json.loads(cache_contents)
-        cache_file.close()
-    except:
-        cache_dict = {}
-    return cache_dict
+    params = {
+        "origin": site_object.address,
+        "radius": 10,
+        "maxMatches": 10,
+        "ambiguities": "ignore",
+        "outFormat": "json",
+        "key": secrets.API_KEY,
+    }
+    response = SESSION.get(MAPQUEST_URL, params=params,
+                           timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+
+def prefetch_nearby_places(site_ls):
+    '''Queue background MapQuest requests for the first few sites.
+
+    Only the network request runs in the background, on a fixed set of
+    daemon threads so an unfinished prefetch never delays exit.
+    Responses are written to the cache by store_prefetched_places, which
+    keeps the SQLite connection on the main thread.
+
+    Parameters
+    ----------
+    site_ls: list
+        a list of national site instances
+
+    Returns
+    -------
+    None
+    '''
+    while len(NEAR_PREFETCH_THREADS) < NEAR_PREFETCH_COUNT:
+        thread = threading.Thread(target=_prefetch_worker, daemon=True)
+        thread.start()
+        NEAR_PREFETCH_THREADS.append(thread)
+    for site_object in site_ls[:NEAR_PREFETCH_COUNT]:
+        near_key = site_object.info()
+        if (near_key in NEAR_PREFETCH or near_key in NEAR_PLACES_CACHE
+                or CACHE.contains("near", near_key)):
+            continue
+        NEAR_PREFETCH.add(near_key)
+        NEAR_PREFETCH_REQUESTS.put((near_key, site_object))
+
+
+def _prefetch_worker():
+    while True:
+        near_key, site_object = NEAR_PREFETCH_REQUESTS.get()
+        try:
+            content = fetch_nearby_places(site_object)
+        except Exception:
+            content = None
+        NEAR_PREFETCH_RESULTS.put((near_key, content))
 
 
-def save_cache(cache_dict, filename):
-    ''' Saves the current state of the cache to disk
+def store_prefetched_places(wait_for=None):
+    '''Move finished prefetch responses into the cache.
+
+    Responses that failed or do not parse as JSON are dropped, so the
+    site is fetched normally when it is chosen.
 
     Parameters
     ----------
-    cache_dict: dict
-        The dictionary to save
+    wait_for: string
+        a site key; if its prefetch is still running, block until it
+        finishes
 
     Returns
     -------
     None
     '''
-    dumped_json_cache = json.dumps(cache_dict)
-    fw = open(filename, "w")
-    fw.write(dumped_json_cache)
-    fw.close()
+    while NEAR_PREFETCH:
+        try:
+            near_key, content = NEAR_PREFETCH_RESULTS.get(
+                block=wait_for in NEAR_PREFETCH)
+        except queue.Empty:
+            return
+        NEAR_PREFETCH.discard(near_key)
+        if content is None:
+            continue
+        try:
+            places = json_loads(content)
+        except ValueError:
+            continue
+        CACHE.put_raw("near", near_key, content)
+        NEAR_PLACES_CACHE[near_key] = places
 
 
+def json_dumps(obj):
+    ''' Serializes an object to JSON bytes, using orjson when available
+
+    Parameters
+    ----------
+    obj: dict or list
+        The object to serialize
+
+    Returns
+    -------
+    bytes
+        The UTF-8 encoded JSON
+    '''
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+def json_loads(data):
+    ''' Parses JSON bytes or str, using orjson when available
+
+    Parameters
+    ----------
+    data: bytes or str
+        The JSON document
+
+    Returns
+    -------
+    The parsed object: dict or list
+    '''
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def encode_value(obj):
+    ''' Serializes a cache value, compressing it when it is large
+
+    Parameters
+    ----------
+    obj: dict, list or string
+        The JSON-serializable value
+
+    Returns
+    -------
+    string or bytes
+        the JSON text, or zlib-compressed JSON bytes for large values
+    '''
+    return encode_json(json_dumps(obj))
+
+
+def encode_json(data):
+    ''' Prepares an already-serialized JSON document for storage
+
+    Parameters
+    ----------
+    data: bytes
+        The UTF-8 encoded JSON
+
+    Returns
+    -------
+    string or bytes
+        the JSON text, or zlib-compressed JSON bytes for large values
+    '''
+    if len(data) >= CACHE_COMPRESS_MIN_SIZE:
+        return zlib.compress(data, CACHE_COMPRESS_LEVEL)
+    return data.decode("utf-8")
+
+
+def decode_value(data):
+    ''' Parses a value produced by encode_value
+
+    Parameters
+    ----------
+    data: string or bytes
+        The stored JSON text or compressed JSON bytes
+
+    Returns
+    -------
+    The parsed object: dict, list or string
+    '''
+    if isinstance(data, bytes):
+        data = zlib.decompress(data)
+    return json_loads(data)
+
+
+class CacheDB:
+    '''a keyed on-disk cache stored in one SQLite file
+
+    Each table maps a text key to a value, so a lookup or an update
+    touches a single row instead of the whole cache. Tables listed in
+    TEXT_TABLES hold plain strings; the others hold JSON-serialized
+    values, stored zlib-compressed when large. Each put is committed
+    as soon as it is written, so nothing is lost if the process is
+    killed and no write lock is held while the CLI waits for input.
+
+    Instance Attributes
+    -------------------
+    filename: string
+        the path of the SQLite database (e.g. 'cache.db')
+    '''
+
+    # table name -> (key column, value column)
+    TABLES = {
+        "state_urls": ("name", "url"),
+        "parks": ("state_url", "json"),
+        "near": ("site_key", "json"),
+    }
+    # tables whose values are plain strings stored without JSON encoding
+    TEXT_TABLES = frozenset(("state_urls",))
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.filename)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for table, (key_col, value_col) in self.TABLES.items():
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS {} "
+                    "({} TEXT PRIMARY KEY, {} TEXT)".format(
+                        table, key_col, value_col))
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, table, key):
+        ''' Looks up one cached value
+
+        Parameters
+        ----------
+        table: string
+            one of the names in CacheDB.TABLES
+        key: string
+            the row key
+
+        Returns
+        -------
+        The cached value, or None if the key is not cached
+        '''
+        key_col, value_col = self.TABLES[table]
+        row = self._connect().execute(
+            "SELECT {} FROM {} WHERE {} = ?".format(value_col, table, key_col),
+            (key,)).fetchone()
+        if row is None:
+            return None
+        return self._decode(table, row[0])
+
+    def contains(self, table, key):
+        ''' Checks whether a key is cached, without reading its value
+
+        Parameters
+        ----------
+        table: string
+            one of the names in CacheDB.TABLES
+        key: string
+            the row key
+
+        Returns
+        -------
+        bool
+            True if the key is cached
+        '''
+        key_col, _ = self.TABLES[table]
+        row = self._connect().execute(
+            "SELECT 1 FROM {} WHERE {} = ?".format(table, key_col),
+            (key,)).fetchone()
+        return row is not None
+
+    def items(self, table):
+        ''' Returns every (key, value) pair cached in a table
+
+        Parameters
+        ----------
+        table: string
+            one of the names in CacheDB.TABLES
+
+        Returns
+        -------
+        list
+            a list of (key, value) tuples
+        '''
+        key_col, value_col = self.TABLES[table]
+        rows = self._connect().execute(
+            "SELECT {}, {} FROM {}".format(key_col, value_col, table))
+        return [(key, self._decode(table, value)) for key, value in rows]
+
+    def put(self, table, key, value):
+        ''' Stores one value, replacing any existing row for the key
+
+        Parameters
+        ----------
+        table: string
+            one of the names in CacheDB.TABLES
+        key: string
+            the row key
+        value: dict, list or string
+            the value to store: a string for TEXT_TABLES, otherwise
+            any JSON-serializable value
+
+        Returns
+        -------
+        None
+        '''
+        self.put_many(table, [(key, value)])
+
+    def put_raw(self, table, key, data):
+        ''' Stores a value that is already serialized as JSON bytes
+
+        Parameters
+        ----------
+        table: string
+            one of the names in CacheDB.TABLES
+        key: string
+            the row key
+        data: bytes
+            the UTF-8 encoded JSON, stored without re-serializing it
+
+        Returns
+        -------
+        None
+        '''
+        self._write(table, [(key, encode_json(data))])
+
+    def put_many(self, table, items):
+        ''' Stores several values in a single transaction
+
+        Parameters
+        ----------
+        table: string
+            one of the names in CacheDB.TABLES
+        items: iterable
+            (key, value) pairs to store
+
+        Returns
+        -------
+        None
+        '''
+        self._write(
+            table,
+            [(key, self._encode(table, value)) for key, value in items])
+
+    def _encode(self, table, value):
+        if table in self.TEXT_TABLES:
+            return value
+        return encode_value(value)
+
+    def _decode(self, table, data):
+        if table in self.TEXT_TABLES:
+            return data
+        return decode_value(data)
+
+    def _write(self, table, rows):
+        key_col, value_col = self.TABLES[table]
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO {} ({}, {}) VALUES (?, ?)".format(
+                    table, key_col, value_col),
+                rows)
+
+    def close(self):
+        ''' Closes the database connection, if one is open
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+CACHE = CacheDB(CACHE_FILENAME)
+atexit.register(store_prefetched_places)
+
 if __name__ == "__main__":
 
     state_url = "https://www.nps.gov/state/mi/index.htm"
-    STATE_CACHE_DICT = open_cache(STATE_CACHE_FILENAME)
-    PARK_CACHE_DICT = open_cache(PARK_CACHE_FILENAME)
-    NEAR_CACHE_DICT = open_cache(NEAR_CACHE_FILENAME)
     state_url_dict = build_state_url_dict()
     outerLoop = True
     while outerLoop:
@@ -271,21 +698,27 @@ if __name__ == "__main__":
         print("---------------------")
         for i, park in enumerate(park_ls):
             print("[{}] {}".format(i+1, park.info()))
+        prefetch_nearby_places(park_ls)
 
         while True:
             number = input(
-                "Choosethe number for detail search or exit or back: ")
+                "Choosethe number for detail search or exit or back: ").strip().lower()
 
             if number == "back":
                 break
             if number == "exit":
                 outerLoop = False
                 break
-            if int(number) > len(park_ls):
+            try:
+                idx = int(number) - 1
+            except ValueError:
+                print("[Error] Invalid input")
+                continue
+            if not 0 <= idx < len(park_ls):
                 print("[Error] Invalid input")
                 continue
 
-            near_places = get_nearby_places(park_ls[int(number)-1])[
+            near_places = get_nearby_places(park_ls[idx])[
                 "searchResults"]
 
             for i in range(len(near_places)):
@@ -1,4 +1,10 @@
+import os
+import queue
+import sqlite3
+import tempfile
 import unittest
+from contextlib import closing
+from unittest import mock
 import proj2_nps as nps
 
 # SI 507 Fall 2020
@@ -79,6 +85,29 @@ class Test_Part3(unittest.TestCase):
             "Bighorn Canyon (National Recreation Area): Lovell, WY 82431")
 
 
+class Test_Sites(unittest.TestCase):
+    def setUp(self):
+        self.site = nps.NationalSite("National Park", "Yellowstone",
+                                     "Yellowstone National Park, WY",
+                                     "82190-0168", "307-344-7381")
+        self.state_url = "https://www.nps.gov/state/wy/index.htm"
+
+    def tearDown(self):
+        nps.PARK_OBJ_CACHE.pop(self.state_url, None)
+
+    def test_sites_1_dict_round_trip(self):
+        site = nps.cache_to_obj([self.site.to_dict()])[0]
+        self.assertEqual(site.to_dict(), self.site.to_dict())
+        self.assertEqual(site.info(), self.site.info())
+
+    def test_sites_2_memory_cache(self):
+        nps.PARK_OBJ_CACHE[self.state_url] = (self.site,)
+        sites = nps.get_sites_for_state(self.state_url)
+        self.assertIs(sites[0], self.site)
+        sites.clear()
+        self.assertEqual(len(nps.get_sites_for_state(self.state_url)), 1)
+
+
 class Test_Part4(unittest.TestCase):
     def setUp(self):
         self.site_mi2 = nps.get_site_instance(
@@ -101,5 +130,129 @@ class Test_Part4(unittest.TestCase):
         self.assertEqual(self.near_wy['options']['radius'], 10)
 
 
+class Test_NearbyPlaces(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = nps.CacheDB(os.path.join(self.tmpdir.name, "cache.db"))
+        for name, value in (("CACHE", self.cache),
+                            ("NEAR_PLACES_CACHE", {}),
+                            ("NEAR_PREFETCH", set()),
+                            ("NEAR_PREFETCH_RESULTS", queue.Queue())):
+            patcher = mock.patch.object(nps, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.site = nps.NationalSite("National Park", "Yellowstone",
+                                     "Yellowstone National Park, WY",
+                                     "82190-0168", "307-344-7381")
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def test_near_1_unparseable_not_cached(self):
+        body = b"The AppKey submitted with this request is invalid."
+        with mock.patch.object(nps, "fetch_nearby_places",
+                               return_value=body):
+            with self.assertRaises(ValueError):
+                nps.get_nearby_places(self.site)
+        self.assertIsNone(self.cache.get("near", self.site.info()))
+
+    def test_near_2_memory_cache(self):
+        with mock.patch.object(nps, "fetch_nearby_places",
+                               return_value=b'{"resultsCount": 10}') as fetch:
+            places = nps.get_nearby_places(self.site)
+            self.assertIs(nps.get_nearby_places(self.site), places)
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(self.cache.get("near", self.site.info()), places)
+
+    def test_near_3_prefetched(self):
+        nps.NEAR_PREFETCH.update(("Yellowstone", "Isle Royale"))
+        nps.NEAR_PREFETCH_RESULTS.put(
+            ("Yellowstone", b'{"resultsCount": 10}'))
+        nps.NEAR_PREFETCH_RESULTS.put(
+            ("Isle Royale",
+             b"The AppKey submitted with this request is invalid."))
+        nps.store_prefetched_places()
+        self.assertEqual(nps.NEAR_PREFETCH, set())
+        self.assertEqual(nps.NEAR_PLACES_CACHE["Yellowstone"],
+                         {"resultsCount": 10})
+        self.assertEqual(self.cache.get("near", "Yellowstone"),
+                         {"resultsCount": 10})
+        self.assertFalse(self.cache.contains("near", "Isle Royale"))
+
+    def test_near_4_failed_prefetch_falls_back(self):
+        nps.NEAR_PREFETCH.add(self.site.info())
+        nps.NEAR_PREFETCH_RESULTS.put((self.site.info(), None))
+        with mock.patch.object(nps, "fetch_nearby_places",
+                               return_value=b'{"resultsCount": 10}') as fetch:
+            self.assertEqual(nps.get_nearby_places(self.site),
+                             {"resultsCount": 10})
+        self.assertEqual(fetch.call_count, 1)
+
+
+class Test_Cache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = nps.CacheDB(os.path.join(self.tmpdir.name, "cache.db"))
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def test_cache_1_miss(self):
+        self.assertIsNone(self.cache.get("near", "nothing here"))
+
+    def test_cache_2_round_trip(self):
+        sites = [{"category": "National Park", "name": "Yellowstone",
+                  "address": "Yellowstone National Park, WY",
+                  "zipcode": "82190-0168", "phone": "307-344-7381"}]
+        self.cache.put("parks", "https://www.nps.gov/state/wy/index.htm",
+                       sites)
+        self.assertEqual(
+            self.cache.get("parks", "https://www.nps.gov/state/wy/index.htm"),
+            sites)
+
+    def test_cache_3_items(self):
+        self.cache.put_many("state_urls", [
+            ("michigan", "https://www.nps.gov/state/mi/index.htm"),
+            ("wyoming", "https://www.nps.gov/state/wy/index.htm")])
+        self.assertEqual(
+            dict(self.cache.items("state_urls"))["wyoming"],
+            "https://www.nps.gov/state/wy/index.htm")
+        with closing(sqlite3.connect(self.cache.filename)) as conn:
+            stored = conn.execute(
+                "SELECT url FROM state_urls WHERE name = ?",
+                ("wyoming",)).fetchone()[0]
+        self.assertEqual(stored, "https://www.nps.gov/state/wy/index.htm")
+
+    def test_cache_4_committed(self):
+        self.cache.put("near", "Yellowstone", {"resultsCount": 10})
+        reopened = nps.CacheDB(self.cache.filename)
+        self.assertEqual(reopened.get("near", "Yellowstone"),
+                         {"resultsCount": 10})
+        reopened.close()
+
+    def test_cache_5_compressed(self):
+        places = {"searchResults": [{"name": "place {}".format(i)}
+                                    for i in range(100)]}
+        self.cache.put("near", "Yellowstone", places)
+        with closing(sqlite3.connect(self.cache.filename)) as conn:
+            stored = conn.execute(
+                "SELECT json FROM near WHERE site_key = ?",
+                ("Yellowstone",)).fetchone()[0]
+        self.assertIsInstance(stored, bytes)
+        self.assertEqual(self.cache.get("near", "Yellowstone"), places)
+
+    def test_cache_6_raw(self):
+        self.cache.put_raw("near", "Yellowstone", b'{"resultsCount": 10}')
+        self.assertEqual(self.cache.get("near", "Yellowstone"),
+                         {"resultsCount": 10})
+
+    def test_cache_7_contains(self):
+        self.assertFalse(self.cache.contains("near", "Yellowstone"))
+        self.cache.put("near", "Yellowstone", {"resultsCount": 10})
+        self.assertTrue(self.cache.contains("near", "Yellowstone"))
+
+
 if __name__ == '__main__':
     unittest.main()